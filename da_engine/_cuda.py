@@ -0,0 +1,87 @@
+"""
+CuPy versions of the analysis kernels in _kernels.
+
+For large problems (m N above ~1e6) the gemm chain is compute bound and runs much faster
+on a GPU. The kernels take host arrays, run the update on the device and copy the
+analysed ensemble back. cupy is optional and only needed when device='cuda'.
+"""
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+
+def _require_cupy():
+    if cp is None:
+        raise ImportError("device='cuda' requires cupy to be installed")
+
+
+def _truncated_svd(HE, truncation, use_percent):
+    """ Thin SVD of HE on the device, truncated on the host (s is only min(m, N) long) """
+    m, N = HE.shape
+    if m > N:
+        # R-SVD: cusolver's gesvd has no QR crossover for tall matrices, so compress
+        # HE = QR first and only decompose the N x N R
+        q, r = cp.linalg.qr(HE, mode='reduced')
+        ur, s, vt = cp.linalg.svd(r, full_matrices=False)
+        u = q @ ur
+    else:
+        u, s, vt = cp.linalg.svd(HE, full_matrices=False)
+    s2 = cp.asnumpy(s) ** 2
+    sums_ = s2.sum()
+    if use_percent:
+        keep = s2 / sums_ >= truncation
+    else:
+        keep = s2 >= truncation
+    p = int(keep.sum())
+    share = 100.0 * s2[:p].sum() / sums_
+    return u[:, :p], cp.asarray(1.0 / s2[:p], dtype=HE.dtype), p, share
+
+
+def enkf_core(HE, H_dash, K, K_dash, D_dash, truncation, use_percent):
+    """
+    EnKF update K + K'H'^T U S^-2 U^T D' on the GPU.
+
+    Returns the analysed ensemble (host array), the number of singular values kept and
+    their share.
+    """
+    _require_cupy()
+    HE, H_dash, K, K_dash, D_dash = (cp.asarray(a) for a in (HE, H_dash, K, K_dash, D_dash))
+    u, s_, p, share = _truncated_svd(HE, truncation, use_percent)
+
+    UtD = u.T @ D_dash
+    UtD *= s_[:, None]
+    x4 = (H_dash.T @ u) @ UtD
+
+    return cp.asnumpy(K + K_dash @ x4), p, share
+
+
+def sqrtkf_core(HE, H_dash, K_mean, K_dash, innov, theta, truncation, use_percent):
+    """
+    Square root filter update on the GPU. theta is the N x N random rotation applied
+    to the analysed anomalies.
+
+    Returns the analysed ensemble (host array), the number of singular values kept and
+    their share.
+    """
+    _require_cupy()
+    HE, H_dash, K_mean, K_dash, innov, theta = (
+        cp.asarray(a) for a in (HE, H_dash, K_mean, K_dash, innov, theta))
+    N = H_dash.shape[1]
+    u, s_, p, share = _truncated_svd(HE, truncation, use_percent)
+    HtU = H_dash.T @ u
+
+    # mean update
+    x2 = (u.T @ innov) * s_
+    Ka = K_mean + K_dash @ (HtU @ x2)
+
+    # symmetric square root of I - Y(C^-1)Y
+    W = HtU * cp.sqrt(s_)[None, :]
+    c_1 = cp.eye(N, dtype=W.dtype) - W @ W.T
+    lam, v = cp.linalg.eigh(c_1)
+    lam[lam < 0] = 0
+    T = (v * cp.sqrt(lam)[None, :]) @ v.T
+
+    Aa = (K_dash @ T) @ theta.T + Ka[:, None]
+    return cp.asnumpy(Aa), p, share
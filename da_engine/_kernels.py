@@ -0,0 +1,107 @@
+"""
+Compiled kernels for the analysis step.
+
+For small to medium ensembles (N up to a few hundred) the cost of EnKF and Sqrt_KF is
+dominated by the Python/NumPy dispatch around each BLAS call rather than the BLAS work
+itself. These kernels run the whole linear-algebra chain under numba. numba is optional:
+without it the kernels are plain NumPy functions.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+
+@njit(parallel=True, cache=True)
+def center(A, mean):
+    """
+    Anomalies A - mean[:, None] as a Fortran-ordered array. Columns are independent,
+    so each thread handles its own contiguous columns. Only worth calling when numba
+    is installed; the pure Python fallback is a plain double loop.
+    """
+    m, N = A.shape
+    out = np.empty((N, m), dtype=A.dtype).T
+    for j in prange(N):
+        for i in range(m):
+            out[i, j] = A[i, j] - mean[i]
+    return out
+
+
+@njit(cache=True, fastmath=True)
+def _truncate(s, truncation, use_percent):
+    """ Number of dominant singular values kept and their share of the total variance """
+    s2 = s * s
+    sums_ = np.sum(s2)
+    if use_percent:
+        keep = s2 / sums_ >= truncation
+    else:
+        keep = s2 >= truncation
+    p = int(np.sum(keep))
+    return p, s2[:p], 100.0 * np.sum(s2[:p]) / sums_
+
+
+@njit(cache=True, fastmath=True)
+def enkf_core(HE, H_dash, K, K_dash, D_dash, truncation, use_percent):
+    """
+    EnKF update K + K'H'^T U S^-2 U^T D' where U S V^T is the thin SVD of HE = H' + E.
+
+    Returns the analysed ensemble, the number of singular values kept and their share.
+    """
+    u, s, vt = np.linalg.svd(HE, full_matrices=False)
+    p, s2, share = _truncate(s, truncation, use_percent)
+    u = np.ascontiguousarray(u[:, :p])
+
+    UtD = u.T @ D_dash
+    for i in range(p):
+        UtD[i, :] /= s2[i]
+    x4 = (H_dash.T @ u) @ UtD
+
+    return K + K_dash @ x4, p, share
+
+
+@njit(cache=True, fastmath=True)
+def sqrtkf_core(HE, H_dash, K_mean, K_dash, innov, theta, truncation, use_percent):
+    """
+    Square root filter update. theta is the N x N random rotation applied to the
+    analysed anomalies.
+
+    Returns the analysed ensemble, the number of singular values kept and their share.
+    """
+    N = H_dash.shape[1]
+    u, s, vt = np.linalg.svd(HE, full_matrices=False)
+    p, s2, share = _truncate(s, truncation, use_percent)
+    u = np.ascontiguousarray(u[:, :p])
+
+    # mean update
+    x2 = u.T @ innov
+    for i in range(p):
+        x2[i] /= s2[i]
+    Ka = K_mean + K_dash @ (H_dash.T @ (u @ x2))
+
+    # I - Y(C^-1)Y, with C^-1 = U S^-2 U^T
+    W = u.T @ H_dash
+    WS = W.copy()
+    for i in range(p):
+        WS[i, :] /= s2[i]
+    c_1 = np.eye(N, dtype=H_dash.dtype) - W.T @ WS
+
+    # symmetric square root of I - Y(C^-1)Y
+    lam, v = np.linalg.eigh(c_1)
+    lam[lam < 0] = 0
+    lam = np.sqrt(lam)
+    T = (v * lam) @ v.T
+
+    Aa = (K_dash @ T) @ theta.T
+    for j in range(N):
+        Aa[:, j] += Ka
+    return Aa, p, share
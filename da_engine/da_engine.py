@@ -5,13 +5,63 @@ __email__ = "aalzraiee@usgs.gov"
 import numpy as np
 from scipy.linalg import blas as blas
 from scipy.linalg import lapack as lap
-from scipy.stats import ortho_group
+
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    Parallel = None
+
+from . import _cuda
+from . import _kernels
+
+
+def thin_svd(a):
+    """
+    Economy SVD of a(m, N). Only the first min(m, N) left singular vectors are
+    computed; the right singular vectors are not needed by the filters and are dropped.
+    Uses the divide-and-conquer driver (?gesdd) when available; the precision follows a.
+    For m >> N, LAPACK already compresses a with a QR and decomposes the N x N R factor,
+    so no explicit R-SVD is done here.
+    """
+    if hasattr(lap, 'dgesdd'):
+        gesvd = lap.get_lapack_funcs('gesdd', (a,))
+    else:
+        gesvd = lap.get_lapack_funcs('gesvd', (a,))
+    u, s, vt, ierr = gesvd(a, compute_uv=1, full_matrices=0)
+    return u, s, ierr
+
+
+def random_orthogonal(N, dtype=np.float64, rng=None):
+    """
+    Random N x N orthogonal matrix, uniform (Haar) over the orthogonal group. QR of a
+    Gaussian matrix with the signs of R's diagonal folded into Q, which is what
+    scipy.stats.ortho_group does without the per-call overhead. rng is a numpy Generator,
+    a fresh default one is used when it is None.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    Q, R = np.linalg.qr(rng.standard_normal((N, N)))
+    Q *= np.sign(np.diag(R))[np.newaxis, :]
+    return Q.astype(dtype, order='F')
+
+
+def _local_update(K, H, D, d, E, k_idx, h_idx, seed, **kwargs):
+    """
+    Analysis of a single sub-domain; module level so it can be sent to joblib workers.
+    The full arrays are passed with the sub-domain's row indices and sliced here, so
+    joblib memory-maps each array once for all tasks.
+    """
+    d = None if d is None else d[h_idx]
+    E = None if E is None else E[h_idx]
+    return Analysis(K=K[k_idx], H=H[h_idx], D=D[h_idx], d=d, E=E, seed=seed,
+                    verbose=False, **kwargs).update()
 
 
 class Analysis(object):
     def __init__(self, K=None, H=None, D=None, d=None, R=None,
                  method='enkf', err_std=None, err_perc=None, E=None,
-                 truncation=None, truncation_percent=0.01, verbose=True):
+                 truncation=None, truncation_percent=0.01, verbose=True, use_numba=False,
+                 dtype=np.float32, device='cpu', seed=None):
 
         """
         Data Assimilation tools
@@ -28,6 +78,15 @@ class Analysis(object):
         d(m)          : observations
         mode          : Two methods are supported [EnKF, SRKF]
         truncation    : fraction of eigen vector to be removed
+        use_numba     : run the update as a single numba-compiled kernel. Pays off for
+                        small ensembles (N up to ~200), where per-call overhead dominates
+        device        : 'cpu' or 'cuda'. 'cuda' runs the update on the GPU with cupy, worth it
+                        for large problems (m N above ~1e6)
+        dtype         : floating point precision of the update. float32 halves memory traffic
+                        and is enough for the usual truncation levels; pass np.float64 when
+                        H' + E is ill-conditioned or a tiny truncation threshold is used
+        seed          : seed of the random generator (PCG64) used for the measurement
+                        perturbations and the square root rotation
 
 
         """
@@ -35,6 +94,12 @@ class Analysis(object):
         if verbose:
             print(" Analysis: verbose is on")
 
+        self.dtype = np.dtype(dtype)
+        self._rng = np.random.default_rng(seed)
+
+        # (m, 1) vector with D = d_offset + E, when D is built from d and E here
+        d_offset = None
+
         # Get and check the dimensions
         m1, N1 = H.shape
         n1, N2 = K.shape
@@ -65,8 +130,9 @@ class Analysis(object):
                 if verbose:
                     print("    Compute measurement error from D by assuming the average of D is d")
                 d = np.mean(D, axis=1)
+                # zero mean by construction, d is the mean of D
                 E = D - d.reshape(m1, 1)
-                E - E.mean(axis=1).reshape(m1, 1)
+                d_offset = d.reshape(m1, 1)
 
 
             else:
@@ -76,15 +142,19 @@ class Analysis(object):
                 if D is None:
                     print("    Trying to generate meas. errors form user defined errors value or percentage")
                     if not (err_std is None):
-                        E = err_std * np.random.randn(m1, N1)
+                        E = self._rng.standard_normal((m1, N1), dtype=self.dtype)
+                        E *= np.reshape(err_std, (-1, 1))
                     elif not (err_perc is None):
                         err_std = err_perc * np.std(H, axis=1)
-                        E = err_std * np.random.randn(m1, N1)
+                        E = self._rng.standard_normal((m1, N1), dtype=self.dtype)
+                        E *= np.reshape(err_std, (-1, 1))
                     else:
                         print(" No information is available to compute measurement errors")
                 else:
                     E = D - d
-                    E - E.mean(axis=1).reshape(m1, 1)
+                    E_mean = E.mean(axis=1, keepdims=True)
+                    E = E - E_mean
+                    d_offset = d + E_mean
 
         if not (method.lower() in ['enkf', 'sqrtkf']):
             ValueError(" Mode is supported")
@@ -96,23 +166,100 @@ class Analysis(object):
             if E is None:
                 ValueError("Error: measurements can not be perturbed")
             if 1 in d.shape:
-                while np.rank(d) > 1:
+                while np.ndim(d) > 1:
                     d = np.squeeze(d)
             d = d.reshape(len(d), 1)
 
             D = d + E
+            d_offset = d
 
         if verbose: print('      analysis: Ensemble Kalman Filter (EnKF)')
-        self.K = K
-        self.H = H
+        # keep the ensembles in Fortran order, the layout BLAS/LAPACK work in
+        # K, H and E are read-only properties: the anomalies and the SVD are cached from them
+        self._K = np.asfortranarray(K, dtype=self.dtype)
+        self._H = np.asfortranarray(H, dtype=self.dtype)
         self.R = R
-        self.E = E
-        self.D = D
-        self.d = d
+        self._E = None if E is None else np.asfortranarray(E, dtype=self.dtype)
+        self.D = np.asfortranarray(D, dtype=self.dtype)
+        self._d_offset = None if d_offset is None else np.asarray(d_offset, dtype=self.dtype)
+        self.d = None if d is None else np.asarray(d, dtype=self.dtype)
         self.truncation = truncation
         self.truncation_percent = truncation_percent
         self.verbose = verbose
         self.method = method.lower()
+        self.use_numba = use_numba
+        self.device = device.lower()
+        if self.device not in ['cpu', 'cuda']:
+            raise ValueError("device must be 'cpu' or 'cuda'")
+
+        # ensemble means and anomalies shared by EnKF and Sqrt_KF, computed on first use
+        self._h_mean = None
+        self._k_mean = None
+        self._H_dash = None
+        self._K_dash = None
+
+        # truncated SVD of H' + E, filled on the first update, with the truncation
+        # settings it was computed for
+        self._svd = None
+        self._svd_settings = None
+
+        # BLAS/LAPACK routines matching dtype (dgemm or sgemm, ...)
+        self._gemm, self._gemv, self._syrk = blas.get_blas_funcs(('gemm', 'gemv', 'syrk'),
+                                                                 dtype=self.dtype)
+        self._syevd, = lap.get_lapack_funcs(('syevd',), dtype=self.dtype)
+
+        # work buffers for the N x N and n x N products, written in place by gemm
+        self._buf_NN = np.zeros((N1, N1), dtype=self.dtype, order='F')
+        self._buf_nN = np.zeros((n1, N1), dtype=self.dtype, order='F')
+
+    @property
+    def K(self):
+        """ Ensemble of parameters/states, (n, N) """
+        return self._K
+
+    @property
+    def H(self):
+        """ Ensemble of model predictions, (m, N) """
+        return self._H
+
+    @property
+    def E(self):
+        """ Measurement error ensemble, (m, N) """
+        return self._E
+
+    @property
+    def h_mean(self):
+        """ Ensemble mean of H, (m, 1) """
+        if self._h_mean is None:
+            self._h_mean = self.H.mean(axis=1, keepdims=True)
+        return self._h_mean
+
+    @property
+    def k_mean(self):
+        """ Ensemble mean of K, (n, 1) """
+        if self._k_mean is None:
+            self._k_mean = self.K.mean(axis=1, keepdims=True)
+        return self._k_mean
+
+    @property
+    def H_dash(self):
+        """ Ensemble anomalies H - mean(H), (m, N) """
+        if self._H_dash is None:
+            self._H_dash = self._center(self.H, self.h_mean)
+        return self._H_dash
+
+    @property
+    def K_dash(self):
+        """ Ensemble anomalies K - mean(K), (n, N) """
+        if self._K_dash is None:
+            self._K_dash = self._center(self.K, self.k_mean)
+        return self._K_dash
+
+    def _center(self, A, mean):
+        """ A - mean, column-parallel under numba when use_numba is set and numba is installed """
+        if self.use_numba and _kernels.HAS_NUMBA:
+            return _kernels.center(A, mean[:, 0])
+        return A - mean
 
     def update(self):
         if self.method == 'enkf':
@@ -124,28 +271,83 @@ class Analysis(object):
 
         return Ka
 
-    def EnKF(self):
-
+    def update_local(self, state_partitions, obs_partitions, n_jobs=-1):
         """
+        Localized update. The state is split into sub-domains that are updated
+        independently, each using only the observations relevant to it, in parallel
+        with joblib when it is installed.
+
+        Parameters
+        ----------
+        state_partitions : list of row indices of K, one entry per sub-domain. The
+                           sub-domains must not overlap
+        obs_partitions   : list of row indices of H (and d, D, E) used by each sub-domain
+        n_jobs           : number of joblib workers, -1 uses all cores
 
         Returns
         -------
-
+        Ka(n, N) : analysed ensemble assembled from the sub-domain updates; rows of K not
+                   in any partition are returned unchanged
         """
+        if len(state_partitions) != len(obs_partitions):
+            raise ValueError("state_partitions and obs_partitions must have the same length")
+        rows = np.concatenate([np.arange(self.K.shape[0])[k_idx] for k_idx in state_partitions])
+        if len(np.unique(rows)) != len(rows):
+            raise ValueError("state_partitions must not overlap")
+
+        settings = dict(method=self.method, truncation=self.truncation,
+                        truncation_percent=self.truncation_percent,
+                        use_numba=self.use_numba, dtype=self.dtype,
+                        device=self.device)
+        # independent random streams for the sub-domains, derived from this instance's generator
+        seeds = self._rng.integers(2 ** 63, size=len(state_partitions))
+        arrays = (self.K, self.H, self.D, self.d, self.E)
+        tasks = [arrays + (k_idx, h_idx, seed)
+                 for k_idx, h_idx, seed in zip(state_partitions, obs_partitions, seeds)]
+
+        if Parallel is None or n_jobs == 1:
+            results = [_local_update(*task, **settings) for task in tasks]
+        else:
+            # the same full arrays go to every task; loky memory-maps each of them once
+            # and the workers slice their own rows
+            results = Parallel(n_jobs=n_jobs, backend='loky')(
+                delayed(_local_update)(*task, **settings) for task in tasks)
+
+        # rows outside every partition keep their prior values
+        Ka = self.K.copy()
+        for k_idx, Ka_local in zip(state_partitions, results):
+            Ka[k_idx] = Ka_local
+        return Ka
 
-        # Compute ensemble prior means
-        inflation_factor = 1.0
+    def _core(self):
+        """ Module running the whole update in one call (cupy or numba), None for the BLAS path """
+        if self.device == 'cuda':
+            return _cuda
+        if self.use_numba:
+            return _kernels
+        return None
+
+    def _truncation_args(self):
+        """ (threshold, is_percent) pair passed to the compiled kernels """
+        if self.truncation is None:
+            return self.truncation_percent / 100.0, True
+        return float(self.truncation), False
 
-        H_dash = self.H - np.mean(self.H, axis=1)[:, np.newaxis]
-        HE = H_dash + inflation_factor * self.E
-        K_dash = self.K - np.mean(self.K, axis=1)[:, np.newaxis]
-        D_dash = self.D - self.H
+    def _truncated_svd(self):
+        """
+        Thin SVD of H' + E truncated to its dominant singular values.
 
-        # compute inverse of C = H'H' + R
+        Returns u(m, p), 1/s^2 (p) and H'^T u (N, p). They only depend on H, E and the
+        truncation settings, so they are reused by later updates until truncation or
+        truncation_percent change.
+        """
+        settings = (self.truncation, self.truncation_percent)
+        if self._svd is not None and self._svd_settings == settings:
+            return self._svd
 
-        # SVD of matrix C
-        u, s, vt, ierr = lap.dgesvd(HE)
-        if ierr != 0: ValueError('Sqrt_KF: ierr from call dgesvd = {}'.format(ierr))
+        HE = self.H_dash + self.E
+        u, s, ierr = thin_svd(HE)
+        if ierr != 0: raise ValueError('Analysis: ierr from call gesdd = {}'.format(ierr))
 
         s_ = np.power(s, 2.0)
         sums_ = np.sum(s_)
@@ -162,90 +364,119 @@ class Analysis(object):
               ' share {}, {}'.format(p, 100.0 * (np.sum(s_) / sums_)))
 
         s_ = 1.0 / s_
-
         u = u[:, 0:p]
+        HtU = self._gemm(alpha=1, a=self.H_dash, b=u, trans_a=1)
 
-        x1 = s_[:, np.newaxis] * u.T
-        x2 = blas.dgemm(alpha=1, a=x1, b=D_dash)
-        x3 = blas.dgemm(alpha=1, a=u, b=x2)
-        x4 = blas.dgemm(alpha=1, a=H_dash.T, b=x3)
-
-        Aa = self.K + blas.dgemm(alpha=1, a=K_dash, b=x4)
-
-        return Aa
+        self._svd = (u, s_, HtU)
+        self._svd_settings = settings
+        return self._svd
 
-    def Sqrt_KF(self):
+    def EnKF(self):
 
         """
-        Compute mean least square and ensemble perturbations.
+
+        Returns
+        -------
 
         """
 
         # Compute ensemble prior means
-        prior_k_mean = np.mean(self.K, axis=1)
-        prior_h_mean = np.mean(self.H, axis=1)
-        innov = self.d - prior_h_mean
-        n, N = self.K.shape
-
-        H_dash = self.H - np.mean(self.H, axis=1)[:, np.newaxis]
-        HE = H_dash + self.E
-        K_dash = self.K - np.mean(self.K, axis=1)[:, np.newaxis]
-
-        # SVD of matrix C
-        u, s, vt, ierr = lap.dgesvd(HE)
-        if ierr != 0: ValueError('Sqrt_KF: ierr from call dgesvd = {}'.format(ierr))
-
-        sig = s.copy()
-
-        s_ = np.power(s, 2.0)
-        sums_ = np.sum(s_)
-        if self.truncation is None:
-            s_perc = s_ / np.sum(s_)
-            truncation = self.truncation_percent / 100.0
-            s_ = s_[s_perc >= truncation]
+        H_dash = self.H_dash
+        K_dash = self.K_dash
+
+        core = self._core()
+        if core is not None:
+            HE = H_dash + self.E
+            D_dash = self.D - self.H
+            Aa, p, share = core.enkf_core(HE, H_dash, self.K, K_dash, D_dash,
+                                          *self._truncation_args())
+            print('      analysis: dominant sing. values and'
+                  ' share {}, {}'.format(p, share))
+            return Aa
+
+        # truncated SVD of C = H'H' + R, with H'^T u
+        u, s_, HtU = self._truncated_svd()
+
+        # s^-2 u^T D' with D' = D - H. When D = d_offset + E this is
+        # u^T E + (u^T (d_offset - mean(H))) 1^T - (H'^T u)^T: every term is at anomaly
+        # scale, so no large offset cancels, and D - H (m x N) is never formed
+        if self._d_offset is None:
+            UtD = self._gemm(alpha=1, a=u, b=self.D - self.H, trans_a=1)
         else:
-            truncation = self.truncation
-            s_ = s_[s_ >= truncation]
-
+            UtD = self._gemm(alpha=1, a=u, b=self.E, trans_a=1)
+            UtD -= HtU.T
+            innov = np.asfortranarray(self._d_offset - self.h_mean)
+            UtD += self._gemm(alpha=1, a=u, b=innov, trans_a=1)
+        UtD *= s_[:, np.newaxis]
+
+        # Aa = K + K' (H'^T u) (s^-2 u^T D'), associated whichever way needs fewer flops:
+        # (K' H'^T u) first costs 2 n N p, (H'^T u s^-2 u^T D') first costs N^2 (p + n)
+        n, N = self.K.shape
         p = len(s_)
-        print('      analysis: dominant sing. values and'
-              ' share {}, {}'.format(p, 100.0 * (np.sum(s_) / sums_)))
+        if 2 * n * N * p < N * N * (p + n):
+            KHU = self._gemm(alpha=1, a=K_dash, b=HtU)
+            Aa = self._gemm(alpha=1, a=KHU, b=UtD, beta=1.0, c=self.K)
+        else:
+            x4 = self._gemm(alpha=1, a=HtU, b=UtD, beta=0.0, c=self._buf_NN, overwrite_c=1)
+            Aa = self._gemm(alpha=1, a=K_dash, b=x4, beta=1.0, c=self.K)
 
-        s_ = 1.0 / s_
+        return Aa
 
-        u_ = u[:, 0:p]
+    def Sqrt_KF(self):
 
-        x1 = s_[:, np.newaxis] * u_.T
-        x2 = blas.dgemv(alpha=1, a=x1, x=innov)
-        x3 = blas.dgemv(alpha=1, a=u_, x=x2)
-        x4 = blas.dgemv(alpha=1, a=H_dash.T, x=x3)
+        """
+        Compute mean least square and ensemble perturbations.
 
-        Ka = prior_k_mean + blas.dgemv(alpha=1, a=K_dash, x=x4)
+        """
 
-        # compute C^-1
-        sig = np.power(sig[0:p], -2.0)
-        x2 = sig[:, np.newaxis] * u_.T
-        c_1 = blas.dgemm(alpha=1, a=u_, b=x2)
+        if self.d is None:
+            raise ValueError("Sqrt_KF: the observation vector d is required")
 
-        # I - Y(C^-1)Y
-        c_1 = blas.dgemm(alpha=1, a=c_1, b=H_dash)
-        c_1 = blas.dgemm(alpha=1, a=H_dash.T, b=c_1)
-        diag = 1 - np.diag(c_1)
-        np.fill_diagonal(c_1, diag)
+        # Compute ensemble prior means
+        prior_k_mean = self.k_mean[:, 0]
+        innov = (self.d.reshape(-1, 1) - self.h_mean)[:, 0]
+        n, N = self.K.shape
 
-        # decompose I - Y(C^-1)Y
-        u2, sig2, vt2, ierr = lap.dgesvd(c_1)
+        H_dash = self.H_dash
+        K_dash = self.K_dash
+
+        core = self._core()
+        if core is not None:
+            HE = H_dash + self.E
+            theta = random_orthogonal(N, self.dtype, self._rng)
+            Aa, p, share = core.sqrtkf_core(HE, H_dash, prior_k_mean, K_dash, innov,
+                                            theta, *self._truncation_args())
+            print('      analysis: dominant sing. values and'
+                  ' share {}, {}'.format(p, share))
+            return Aa
+
+        # truncated SVD of matrix C, with H'^T u
+        u_, s_, HtU = self._truncated_svd()
+
+        x2 = self._gemv(alpha=1, a=u_, x=innov, trans=1)
+        x2 *= s_
+        x4 = self._gemv(alpha=1, a=HtU, x=x2)
+
+        Ka = prior_k_mean + self._gemv(alpha=1, a=K_dash, x=x4)
+
+        # Y(C^-1)Y = W W^T with W = H'^T U S^-1, so only the upper triangle is formed (syrk)
+        W = HtU * np.sqrt(s_)[np.newaxis, :]
+        # I - Y(C^-1)Y: syrk with alpha=-1 gives -Y(C^-1)Y, then add 1 to the diagonal
+        c_1 = self._syrk(alpha=-1.0, a=W, trans=0, lower=0, beta=0.0, c=self._buf_NN, overwrite_c=1)
+        c_1[np.diag_indices(N)] += 1
+
+        # decompose I - Y(C^-1)Y, which is symmetric positive semi-definite;
+        # syevd only reads the upper triangle
+        sig2, u2, ierr = self._syevd(c_1)
+        if ierr != 0: raise ValueError('Sqrt_KF: ierr from call syevd = {}'.format(ierr))
         sig2[sig2 < 0] = 0
         sig2 = np.power(sig2, 0.5)
-        p2 = len(sig2)
-        if p2 < N:
-            sig2 = np.append(sig2, np.zeros(N - p2))
         x2 = u2 * sig2[np.newaxis, :]
-        x2 = blas.dgemm(alpha=1.0, a=x2, b=vt2)
+        x2 = self._gemm(alpha=1.0, a=x2, b=u2, trans_b=1, beta=0.0, c=self._buf_NN, overwrite_c=1)
 
-        x2 = blas.dgemm(alpha=1, a=K_dash, b=x2)
-        theta = ortho_group.rvs(N)
-        x2 = blas.dgemm(alpha=1, a=x2, b=theta.T)
-        Aa = Ka[:, np.newaxis] + x2
+        x2 = self._gemm(alpha=1, a=K_dash, b=x2, beta=0.0, c=self._buf_nN, overwrite_c=1)
+        theta = random_orthogonal(N, self.dtype, self._rng)
+        Aa = self._gemm(alpha=1, a=x2, b=theta, trans_b=1)
+        Aa += Ka[:, np.newaxis]
 
         return Aa
@@ -1,6 +1,5 @@
 import os, sys
 import numpy as np
-from statsmodels.distributions.empirical_distribution import ECDF
 
 def normal_to_mixGuassian(ens, mixing_rate = [], mu = [], sig = [], seed = None  ):
     """
@@ -23,21 +22,29 @@ def normal_to_mixGuassian(ens, mixing_rate = [], mu = [], sig = [], seed = None
     if not(seed is None):
         np.random.seed(seed)
 
-    for i in range(number_of_dists):
-        nn = np.round(mixing_rate[i] * number_of_samples)
-        val = mu[i] + sig[i] * np.random.randn(int(nn), 1)
-        if i== 0:
-            samples = val
-        else:
-            samples = np.vstack((samples, val))
-
-    ecdf = ECDF(samples.flatten()) # target cdf
-    ecdf1 = ECDF(ens.flatten())  # currnet cdf
-
-
-    f = np.interp(ens, ecdf1.x, ecdf1.y)
-    mask_inf = np.logical_not(np.isinf(ecdf.x))
-    yy = np.interp(f, ecdf.y[mask_inf], ecdf.x[mask_inf])
+    # draw all modes at once: one RNG call, each mode shifted/scaled by its own mu, sig
+    counts = np.round(np.array(mixing_rate) * number_of_samples).astype(int)
+    mu_arr = np.repeat(np.asarray(mu, dtype=float)[:number_of_dists], counts)
+    sig_arr = np.repeat(np.asarray(sig, dtype=float)[:number_of_dists], counts)
+    samples = mu_arr + sig_arr * np.random.randn(counts.sum())
+
+    # quantile mapping: empirical rank of each ens value -> target quantile.
+    # Tied values share their average rank, so they map to the same output
+    n_ens = ens.size
+    order = np.argsort(ens, axis=None, kind='stable')
+    sorted_ens = ens.ravel()[order]
+    new_run = np.concatenate(([True], sorted_ens[1:] != sorted_ens[:-1]))
+    run_start = np.flatnonzero(new_run)
+    run_end = np.append(run_start[1:], n_ens)
+    run_rank = 0.5 * (run_start + run_end - 1)
+    ranks = np.empty(n_ens)
+    ranks[order] = run_rank[np.cumsum(new_run) - 1]
+    q = (ranks + 0.5) / n_ens
+
+    n_samples = len(samples)
+    target_sorted = np.sort(samples)
+    q_target = np.linspace(0.5 / n_samples, 1 - 0.5 / n_samples, n_samples)
+    yy = np.interp(q, q_target, target_sorted).reshape(ens.shape)
 
     return yy
     
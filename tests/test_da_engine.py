@@ -4,9 +4,13 @@
 
 
 import unittest
+from unittest import mock
+import numpy as np
 from click.testing import CliRunner
 
+from da_engine import _cuda
 from da_engine import da_engine
+from da_engine import geo_utils
 from da_engine import cli
 
 
@@ -15,6 +19,16 @@ class TestDa_engine(unittest.TestCase):
 
     def setUp(self):
         """Set up test fixtures, if any."""
+        rng = np.random.RandomState(0)
+        self.K = rng.randn(15, 30)
+        self.H = rng.randn(10, 30)
+        self.E = 0.3 * rng.randn(10, 30)
+        self.d = rng.randn(10)
+
+    def analysis(self, **kwargs):
+        """Float64 Analysis of the fixture ensemble."""
+        return da_engine.Analysis(K=self.K, H=self.H, E=self.E, d=self.d,
+                                  verbose=False, dtype=np.float64, **kwargs)
 
     def tearDown(self):
         """Tear down test fixtures, if any."""
@@ -22,6 +36,159 @@ class TestDa_engine(unittest.TestCase):
     def test_000_something(self):
         """Test something."""
 
+    def test_measurement_errors_are_centered(self):
+        """E inferred from D and d has zero ensemble mean."""
+        rng = np.random.RandomState(0)
+        K = rng.randn(6, 20)
+        H = rng.randn(4, 20)
+        d = rng.randn(4)
+        D = d[:, np.newaxis] + 1.0 + rng.randn(4, 20)
+        analysis = da_engine.Analysis(K=K, H=H, D=D, d=d, verbose=False,
+                                      dtype=np.float64)
+        np.testing.assert_allclose(analysis.E.mean(axis=1), 0.0, atol=1e-12)
+
+    def test_integer_measurements_are_accepted(self):
+        """Integer-valued D and d still give centered float measurement errors."""
+        rng = np.random.RandomState(1)
+        d = rng.randint(0, 10, size=4)
+        D = d[:, np.newaxis] + rng.randint(-3, 4, size=(4, 20))
+        analysis = da_engine.Analysis(K=rng.randn(6, 20), H=rng.randn(4, 20), D=D, d=d,
+                                      verbose=False, dtype=np.float64)
+        np.testing.assert_allclose(analysis.E.mean(axis=1), 0.0, atol=1e-12)
+
+    def test_default_float32_matches_float64(self):
+        """The default float32 update agrees with float64 to float32 accuracy."""
+        for method in ['enkf', 'sqrtkf']:
+            Ka = self.analysis(method=method, seed=7).update()
+            Ka_32 = da_engine.Analysis(K=self.K, H=self.H, E=self.E, d=self.d, method=method,
+                                       seed=7, verbose=False).update()
+            self.assertEqual(Ka_32.dtype, np.float32)
+            np.testing.assert_allclose(Ka_32, Ka, rtol=1e-4, atol=1e-4)
+
+    def test_sqrt_kf_requires_d(self):
+        """Sqrt_KF without an observation vector raises instead of returning NaNs."""
+        D = self.d[:, np.newaxis] + self.E
+        analysis = da_engine.Analysis(K=self.K, H=self.H, E=self.E, D=D, method='sqrtkf',
+                                      verbose=False)
+        self.assertIsNone(analysis.d)
+        with self.assertRaises(ValueError):
+            analysis.update()
+
+    def test_numba_kernels_match_blas_path(self):
+        """The use_numba kernels give the same update as the BLAS path."""
+        for method in ['enkf', 'sqrtkf']:
+            Ka = self.analysis(method=method, seed=7).update()
+            Ka_numba = self.analysis(method=method, seed=7, use_numba=True).update()
+            np.testing.assert_allclose(Ka_numba, Ka, atol=1e-10)
+
+    def test_sqrt_kf_matches_dense_reference(self):
+        """Sqrt_KF equals Ka + K' sqrt(I - Y'C^-1Y) theta^T computed densely."""
+        Ka = self.analysis(method='sqrtkf', seed=7, truncation=0.0).update()
+
+        N = self.K.shape[1]
+        K_mean = self.K.mean(axis=1)
+        H_mean = self.H.mean(axis=1)
+        K_dash = self.K - K_mean[:, np.newaxis]
+        H_dash = self.H - H_mean[:, np.newaxis]
+        u, s, vt = np.linalg.svd(H_dash + self.E, full_matrices=False)
+        C_inv = (u / s ** 2) @ u.T
+
+        mean = K_mean + K_dash @ H_dash.T @ C_inv @ (self.d - H_mean)
+        lam, v = np.linalg.eigh(np.eye(N) - H_dash.T @ C_inv @ H_dash)
+        T = (v * np.sqrt(np.maximum(lam, 0.0))) @ v.T
+        theta = da_engine.random_orthogonal(N, np.float64, np.random.default_rng(7))
+        expected = mean[:, np.newaxis] + K_dash @ T @ theta.T
+
+        np.testing.assert_allclose(Ka, expected, atol=1e-10)
+
+    def test_truncation_change_refreshes_svd(self):
+        """Changing truncation_percent after an update is used by the next update."""
+        analysis = self.analysis()
+        analysis.update()
+        analysis.truncation_percent = 50.0
+        fresh = self.analysis(truncation_percent=50.0)
+        np.testing.assert_array_equal(analysis.update(), fresh.update())
+        self.assertEqual(len(analysis._truncated_svd()[1]), len(fresh._truncated_svd()[1]))
+        with self.assertRaises(AttributeError):
+            analysis.H = self.H
+
+    def test_enkf_float32_with_large_offset(self):
+        """EnKF in float32 stays accurate when H and D carry a common offset of 1e3."""
+        offset = 1000.0
+        rng = np.random.RandomState(5)
+        E = 0.05 * rng.randn(10, 30)
+        E -= E.mean(axis=1, keepdims=True)
+        innov = self.H.mean(axis=1) + 0.05 * rng.randn(10)
+
+        K_dash = self.K - self.K.mean(axis=1)[:, np.newaxis]
+        H_dash = self.H - self.H.mean(axis=1)[:, np.newaxis]
+        u, s, vt = np.linalg.svd(H_dash + E, full_matrices=False)
+        increment = K_dash @ H_dash.T @ (u / s ** 2) @ u.T @ (innov[:, np.newaxis] - self.H + E)
+
+        for perturbed in [dict(E=E), dict(D=offset + innov[:, np.newaxis] + E)]:
+            Ka = da_engine.Analysis(K=self.K, H=self.H + offset, d=offset + innov,
+                                    truncation=0.0, verbose=False, **perturbed).update()
+            error = np.abs((Ka - self.K) - increment).max() / np.abs(increment).max()
+            self.assertLess(error, 8e-5)
+
+    def test_update_local_full_partition_matches_update(self):
+        """Partitioning the whole state, each part using every observation, equals update()."""
+        analysis = self.analysis()
+        all_obs = np.arange(self.H.shape[0])
+        Ka_local = analysis.update_local([np.arange(0, 7), np.arange(7, 15)],
+                                         [all_obs, all_obs], n_jobs=1)
+        np.testing.assert_allclose(Ka_local, analysis.update(), atol=1e-12)
+
+    def test_update_local_keeps_rows_outside_partitions(self):
+        """State rows not in any partition come back as the prior."""
+        Ka = self.analysis().update_local([np.arange(0, 5)], [np.arange(self.H.shape[0])],
+                                          n_jobs=1)
+        np.testing.assert_array_equal(Ka[5:], self.K[5:])
+
+    def test_update_local_rejects_overlapping_partitions(self):
+        """Overlapping state partitions raise instead of silently keeping the last result."""
+        all_obs = np.arange(self.H.shape[0])
+        with self.assertRaises(ValueError):
+            self.analysis().update_local([np.arange(0, 8), np.arange(7, 15)],
+                                         [all_obs, all_obs], n_jobs=1)
+
+    def test_seeded_runs_are_reproducible(self):
+        """Two analyses with the same seed draw the same E and give the same sqrtkf update."""
+        def seeded():
+            return da_engine.Analysis(K=self.K, H=self.H, d=self.d, err_std=0.3, seed=11,
+                                      method='sqrtkf', verbose=False, dtype=np.float64)
+
+        first, second = seeded(), seeded()
+        np.testing.assert_array_equal(first.E, second.E)
+        np.testing.assert_array_equal(first.update(), second.update())
+
+        partitions = [np.arange(0, 7), np.arange(7, 15)]
+        all_obs = np.arange(self.H.shape[0])
+        np.testing.assert_array_equal(
+            seeded().update_local(partitions, [all_obs, all_obs], n_jobs=2),
+            seeded().update_local(partitions, [all_obs, all_obs], n_jobs=2))
+
+    def test_normal_to_mix_gaussian(self):
+        """Mixture mapping keeps the shape and rank order, maps ties alike, and is seedable."""
+        ens = np.round(np.random.RandomState(3).randn(20, 10), 1)
+        kwargs = dict(mixing_rate=[0.3, 0.7], mu=[0.0, 5.0], sig=[1.0, 0.5], seed=4)
+        yy = geo_utils.normal_to_mixGuassian(ens, **kwargs)
+
+        self.assertEqual(yy.shape, ens.shape)
+        order = np.argsort(ens, axis=None)
+        self.assertTrue(np.all(np.diff(yy.ravel()[order]) >= 0))
+        self.assertEqual(len(np.unique(yy)), len(np.unique(ens)))
+        np.testing.assert_array_equal(geo_utils.normal_to_mixGuassian(ens, **kwargs), yy)
+
+    def test_device_dispatch(self):
+        """device='cuda' needs cupy, and unknown devices are rejected."""
+        with mock.patch.object(_cuda, 'cp', None):
+            for method in ['enkf', 'sqrtkf']:
+                with self.assertRaises(ImportError):
+                    self.analysis(method=method, device='cuda').update()
+        with self.assertRaises(ValueError):
+            self.analysis(device='tpu')
+
     def test_command_line_interface(self):
         """Test the CLI."""
         runner = CliRunner()